@@ -2,10 +2,16 @@
 Valro - Autonomous Home Services Concierge Agent
 Built on AWS Bedrock AgentCore with Strands
 """
+import asyncio
 import os
-import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import lru_cache
 from datetime import datetime, timezone
+import orjson
 from strands import Agent, tool
+from strands.models import BedrockModel
 from bedrock_agentcore.memory.integrations.strands.config import AgentCoreMemoryConfig, RetrievalConfig
 from bedrock_agentcore.memory.integrations.strands.session_manager import AgentCoreMemorySessionManager
 from bedrock_agentcore.tools.code_interpreter_client import CodeInterpreter
@@ -17,14 +23,27 @@ MEMORY_ID = os.getenv("BEDROCK_AGENTCORE_MEMORY_ID")
 REGION = os.getenv("AWS_REGION")
 MODEL_ID = "us.anthropic.claude-sonnet-4-5-20250929-v1:0"
 
-ci_sessions = {}
-current_session = None
+# Latency-optimized inference is not available for every model/region combo,
+# so it stays opt-in via BEDROCK_LATENCY_OPT=1
+BEDROCK_LATENCY_OPT = os.getenv("BEDROCK_LATENCY_OPT") == "1"
 
-# Track tool executions for response
-tool_executions = {
-    'vendors': [],
-    'emails': []
-}
+
+def _build_model():
+    """Build the Bedrock model, forwarding performanceConfig to converse when enabled"""
+    if BEDROCK_LATENCY_OPT:
+        return BedrockModel(
+            model_id=MODEL_ID,
+            additional_args={"performanceConfig": {"latency": "optimized"}}
+        )
+    return BedrockModel(model_id=MODEL_ID)
+
+# Code interpreter sessions, bounded LRU so a warm container doesn't accumulate them
+CI_SESSIONS_MAX = 32
+ci_sessions = OrderedDict()
+
+# Request-scoped state: each invocation sets its own session and tool tracking
+current_session = ContextVar("current_session", default=None)
+tool_executions = ContextVar("tool_executions")
 
 # Mock vendor database for POC
 VENDOR_DATABASE = {
@@ -59,6 +78,42 @@ VENDOR_DATABASE = {
     }
 }
 
+# Flat (service, city) index and per-service fallback, built once at import
+_VENDOR_INDEX = {
+    (service, city): vendors
+    for service, cities in VENDOR_DATABASE.items()
+    for city, vendors in cities.items()
+}
+_VENDOR_DEFAULT_BY_SERVICE = {
+    service: next(iter(cities.values()))
+    for service, cities in VENDOR_DATABASE.items()
+}
+_VENDOR_DEFAULT = VENDOR_DATABASE["landscaping"]["charlotte"]
+
+
+def _lookup_vendors(service: str, city: str) -> list:
+    """Vendors for a service/city, falling back to the service's first city, then Charlotte landscaping"""
+    service_lower = service.lower()
+    return (
+        _VENDOR_INDEX.get((service_lower, city.lower()))
+        or _VENDOR_DEFAULT_BY_SERVICE.get(service_lower)
+        or _VENDOR_DEFAULT
+    )
+
+
+@lru_cache(maxsize=256)
+def _vendors_json(service: str, city: str, budget: float) -> str:
+    """Serialized getVendors result; vendor data is static so the payload can be memoized"""
+    vendors = _lookup_vendors(service, city)
+    return orjson.dumps({
+        "vendors": vendors,
+        "matched_service": service,
+        "matched_city": city,
+        "budget_filter": budget,
+        "count": len(vendors)
+    }).decode()
+
+
 @tool
 def getVendors(service: str, city: str, budget: float = None) -> str:
     """
@@ -72,58 +127,57 @@ def getVendors(service: str, city: str, budget: float = None) -> str:
     Returns:
         JSON string with list of matching vendors
     """
-    service_lower = service.lower()
-    city_lower = city.lower()
-
-    # Try to find matching vendors
-    vendors = []
-    if service_lower in VENDOR_DATABASE:
-        if city_lower in VENDOR_DATABASE[service_lower]:
-            vendors = VENDOR_DATABASE[service_lower][city_lower]
-        else:
-            # If specific city not found, return first available city's vendors
-            first_city = list(VENDOR_DATABASE[service_lower].keys())[0]
-            vendors = VENDOR_DATABASE[service_lower][first_city]
-    else:
-        # Default fallback - return Charlotte landscaping vendors
-        vendors = VENDOR_DATABASE["landscaping"]["charlotte"]
-
     # Track vendors for response
-    tool_executions['vendors'] = vendors
+    tool_executions.get()['vendors'] = _lookup_vendors(service, city)
 
-    result = {
-        "vendors": vendors,
-        "matched_service": service,
-        "matched_city": city,
-        "budget_filter": budget,
-        "count": len(vendors)
+    return _vendors_json(service, city, budget)
+
+# Shared pool for outbound email; max_workers caps concurrent sends
+EMAIL_MAX_CONCURRENCY = 20
+EMAIL_WAIT_TIMEOUT_SECONDS = 10
+_EMAIL_EXECUTOR = ThreadPoolExecutor(max_workers=EMAIL_MAX_CONCURRENCY)
+
+
+def _queue_email(executions: dict, to: str, subject: str, body: str, taskId: str = None) -> dict:
+    """Submit an email to the shared pool without waiting for it to send"""
+    future = _EMAIL_EXECUTOR.submit(_send_email, executions, to, subject, body, taskId)
+    executions['email_futures'].append(future)
+    return {
+        "status": "queued",
+        "recipient": to,
+        "message": "Email queued for sending"
     }
 
-    return json.dumps(result, indent=2)
 
-@tool
-def sendEmail(to: str, subject: str, body: str, taskId: str = None) -> str:
-    """
-    Send an outreach email to a vendor about a homeowner's request.
+async def _wait_for_emails(executions: dict):
+    """Wait briefly for queued emails, without blocking the event loop, so the response reflects what was sent"""
+    futures = executions['email_futures']
+    if not futures:
+        return
+    done, not_done = await asyncio.wait(
+        [asyncio.wrap_future(future) for future in futures],
+        timeout=EMAIL_WAIT_TIMEOUT_SECONDS
+    )
+    for future in done:
+        if future.exception():
+            print(f"ERROR: email send failed: {future.exception()!r}")
+    if not_done:
+        print(f"WARNING: {len(not_done)} emails still sending after {EMAIL_WAIT_TIMEOUT_SECONDS}s")
 
-    Args:
-        to: Vendor email address
-        subject: Email subject line
-        body: Email content/body
-        taskId: Optional task ID to correlate in the app
 
-    Returns:
-        JSON string with send status
-    """
-    # Log the email (for POC, we don't actually send)
+def _send_email(executions: dict, to: str, subject: str, body: str, taskId: str = None) -> dict:
+    """Send (for POC, log) one email and track it in the invocation's tool executions"""
     timestamp = datetime.now(timezone.utc).isoformat()
 
-    print(f"[EMAIL SENT] {timestamp}")
-    print(f"To: {to}")
-    print(f"Subject: {subject}")
-    print(f"Body: {body}")
-    print(f"Task ID: {taskId}")
-    print("-" * 80)
+    # Single print so concurrent sends don't interleave their log lines
+    print(
+        f"[EMAIL SENT] {timestamp}\n"
+        f"To: {to}\n"
+        f"Subject: {subject}\n"
+        f"Body: {body}\n"
+        f"Task ID: {taskId}\n"
+        + "-" * 80
+    )
 
     # Track email for response
     email_record = {
@@ -132,25 +186,67 @@ def sendEmail(to: str, subject: str, body: str, taskId: str = None) -> str:
         "body": body,
         "timestamp": timestamp
     }
-    tool_executions['emails'].append(email_record)
+    executions['emails'].append(email_record)
 
-    return json.dumps({
+    return {
         "status": "sent",
         "timestamp": timestamp,
         "recipient": to,
         "message": "Email sent successfully"
-    })
+    }
+
+@tool
+def sendEmail(to: str, subject: str, body: str, taskId: str = None) -> str:
+    """
+    Send an outreach email to a vendor about a homeowner's request.
+
+    Args:
+        to: Vendor email address
+        subject: Email subject line
+        body: Email content/body
+        taskId: Optional task ID to correlate in the app
+
+    Returns:
+        JSON string with send status
+    """
+    return orjson.dumps(_queue_email(tool_executions.get(), to, subject, body, taskId)).decode()
+
+@tool
+def sendEmails(messages: list[dict]) -> str:
+    """
+    Send outreach emails to several vendors at once.
+
+    Args:
+        messages: One entry per vendor, each with keys "to", "subject", "body" and optional "taskId"
+
+    Returns:
+        JSON string with the queued status of each email, in input order
+    """
+    # Pool threads don't inherit the context, so hand them the tracking dict
+    executions = tool_executions.get()
+    results = [
+        _queue_email(executions, m["to"], m["subject"], m["body"], m.get("taskId"))
+        for m in messages
+    ]
+
+    return orjson.dumps(results).decode()
 
 @tool
 def calculate(code: str) -> str:
     """Execute Python code for calculations or analysis."""
-    session_id = current_session or 'default'
+    session_id = current_session.get() or 'default'
 
-    if session_id not in ci_sessions:
+    if session_id in ci_sessions:
+        ci_sessions.move_to_end(session_id)
+    else:
         ci_sessions[session_id] = {
             'client': CodeInterpreter(REGION),
             'session_id': None
         }
+        if len(ci_sessions) > CI_SESSIONS_MAX:
+            _, evicted = ci_sessions.popitem(last=False)
+            if evicted['session_id']:
+                evicted['client'].stop()
 
     ci = ci_sessions[session_id]
     if not ci['session_id']:
@@ -169,23 +265,35 @@ def calculate(code: str) -> str:
             return stdout
     return "Executed"
 
-@app.entrypoint
-def invoke(payload, context):
-    global current_session, tool_executions
+# Valro system prompt
+VALRO_SYSTEM_PROMPT = """You are Valro, an autonomous home-services concierge. Your purpose is to help homeowners get real work done with local service providers (landscaping, lawn care, cleaning, handyman, painting, small renovations, seasonal services).
 
-    # Reset tool execution tracking for this invocation
-    tool_executions = {
-        'vendors': [],
-        'emails': []
-    }
+When a user describes what they need, you must:
 
-    if not MEMORY_ID:
-        return {"error": "Memory not configured"}
+1. Understand the request and extract: service type, location/city, budget (if present), and timing.
 
-    actor_id = context.headers.get('X-Amzn-Bedrock-AgentCore-Runtime-Custom-Actor-Id', 'user') if hasattr(context, 'headers') else 'user'
+2. Call the getVendors tool to retrieve matching vendors.
 
-    session_id = getattr(context, 'session_id', 'default')
-    current_session = session_id
+3. After getVendors, call the sendEmails tool ONCE with one entry per returned vendor to initiate outreach on behalf of the user.
+
+4. Then tell the user that outreach has been sent and that you are waiting for vendor replies.
+
+Assume this is a long-running task: the user SHOULD NOT have to call, text, or email vendors themselves unless all automated attempts fail. Prefer taking action over asking follow-up questions. Keep responses clear and brief."""
+
+# Agents are cached per (actor, session) so follow-up turns on a warm container
+# skip tool introspection and model setup; bounded LRU to cap memory
+AGENT_CACHE_MAX = 64
+_AGENT_CACHE = OrderedDict()
+_MODEL = _build_model()
+
+
+def _get_agent(actor_id: str, session_id: str) -> Agent:
+    """Return the cached Agent for this actor/session, building it on first use"""
+    key = (actor_id, session_id)
+    agent = _AGENT_CACHE.get(key)
+    if agent is not None:
+        _AGENT_CACHE.move_to_end(key)
+        return agent
 
     memory_config = AgentCoreMemoryConfig(
         memory_id=MEMORY_ID,
@@ -197,39 +305,58 @@ def invoke(payload, context):
         }
     )
 
-    # Valro system prompt
-    valro_system_prompt = """You are Valro, an autonomous home-services concierge. Your purpose is to help homeowners get real work done with local service providers (landscaping, lawn care, cleaning, handyman, painting, small renovations, seasonal services).
+    agent = Agent(
+        model=_MODEL,
+        session_manager=AgentCoreMemorySessionManager(memory_config, REGION),
+        system_prompt=VALRO_SYSTEM_PROMPT,
+        tools=[getVendors, sendEmail, sendEmails]
+    )
 
-When a user describes what they need, you must:
+    _AGENT_CACHE[key] = agent
+    if len(_AGENT_CACHE) > AGENT_CACHE_MAX:
+        _AGENT_CACHE.popitem(last=False)
+    return agent
 
-1. Understand the request and extract: service type, location/city, budget (if present), and timing.
+@app.entrypoint
+async def invoke(payload, context):
+    """Stream text deltas as they are generated, then a final summary payload"""
+    # Fresh tool execution tracking for this invocation
+    executions = {
+        'vendors': [],
+        'emails': [],
+        'email_futures': []
+    }
+    tool_executions.set(executions)
 
-2. Call the getVendors tool to retrieve matching vendors.
+    if not MEMORY_ID:
+        yield {"error": "Memory not configured"}
+        return
 
-3. For each returned vendor, call the sendEmail tool to initiate outreach on behalf of the user.
+    actor_id = context.headers.get('X-Amzn-Bedrock-AgentCore-Runtime-Custom-Actor-Id', 'user') if hasattr(context, 'headers') else 'user'
 
-4. Then tell the user that outreach has been sent and that you are waiting for vendor replies.
+    session_id = getattr(context, 'session_id', 'default')
+    current_session.set(session_id)
 
-Assume this is a long-running task: the user SHOULD NOT have to call, text, or email vendors themselves unless all automated attempts fail. Prefer taking action over asking follow-up questions. Keep responses clear and brief."""
+    agent = _get_agent(actor_id, session_id)
 
-    agent = Agent(
-        model=MODEL_ID,
-        session_manager=AgentCoreMemorySessionManager(memory_config, REGION),
-        system_prompt=valro_system_prompt,
-        tools=[getVendors, sendEmail]
-    )
+    result = None
+    async for event in agent.stream_async(payload.get("prompt", "")):
+        if "data" in event:
+            yield event["data"]
+        elif "result" in event:
+            result = event["result"]
 
-    result = agent(payload.get("prompt", ""))
+    await _wait_for_emails(executions)
 
     # Extract text response
     text_response = result.message.get('content', [{}])[0].get('text', str(result))
 
-    # Return tracked tool execution data
-    return {
+    # Final event carries the tracked tool execution data
+    yield {
         "response": text_response,
-        "vendors": tool_executions.get('vendors', []),
-        "emails": tool_executions.get('emails', []),
-        "emails_sent": len(tool_executions.get('emails', []))
+        "vendors": executions['vendors'],
+        "emails": executions['emails'],
+        "emails_sent": len(executions['emails'])
     }
 
 if __name__ == "__main__":
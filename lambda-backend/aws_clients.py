@@ -0,0 +1,65 @@
+"""
+Shared AWS Clients for the Valro Lambdas
+Each client is built at most once per container, on first use, so a Lambda
+only loads the botocore models for the services it actually calls
+"""
+import os
+from functools import lru_cache
+import boto3
+from botocore.config import Config
+
+REGION = os.environ.get('AWS_REGION', 'us-east-1')
+TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'valro-tasks')
+
+# Shared client config: keep sockets alive and pooled across warm invocations,
+# fail fast on connect and back off adaptively when throttled
+BOTO_CONFIG = Config(
+    tcp_keepalive=True,
+    max_pool_connections=10,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    connect_timeout=1,
+    read_timeout=30
+)
+
+# Agent runs can go quiet for minutes between chunks, well past the shared read timeout.
+# Kept well below the worker's 600s Lambda timeout so one hung agent fails its own
+# record instead of timing out (and redelivering) the whole SQS batch
+AGENT_READ_TIMEOUT_SECONDS = 420
+
+
+@lru_cache(maxsize=None)
+def get_dynamodb():
+    """Get the DynamoDB resource"""
+    return boto3.resource('dynamodb', region_name=REGION, config=BOTO_CONFIG)
+
+
+@lru_cache(maxsize=None)
+def get_table():
+    """Get the tasks DynamoDB table"""
+    return get_dynamodb().Table(TABLE_NAME)
+
+
+@lru_cache(maxsize=None)
+def get_sqs():
+    """Get the SQS client"""
+    return boto3.client('sqs', region_name=REGION, config=BOTO_CONFIG)
+
+
+@lru_cache(maxsize=None)
+def get_bedrock_agentcore():
+    """Get the Bedrock AgentCore client"""
+    return boto3.client(
+        'bedrock-agentcore',
+        region_name=REGION,
+        # No automatic retries: a retried invocation re-runs the agent and its outreach emails
+        config=BOTO_CONFIG.merge(Config(
+            read_timeout=AGENT_READ_TIMEOUT_SECONDS,
+            retries={'total_max_attempts': 1, 'mode': 'standard'}
+        ))
+    )
+
+
+def reset_clients():
+    """Drop all cached clients so they are rebuilt, e.g. after a SnapStart restore"""
+    for factory in (get_dynamodb, get_table, get_sqs, get_bedrock_agentcore):
+        factory.cache_clear()
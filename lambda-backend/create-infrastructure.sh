@@ -3,6 +3,7 @@
 # Valro Infrastructure Setup Script
 # This script creates all AWS resources needed for the async architecture:
 # - DynamoDB table
+# - SQS worker queue
 # - IAM roles and policies
 # - Lambda functions (API and Worker)
 
@@ -19,7 +20,11 @@ ACCOUNT_ID=$(aws sts get-caller-identity --query Account --output text)
 TABLE_NAME="valro-tasks"
 API_LAMBDA_NAME="valro-backend"
 WORKER_LAMBDA_NAME="valro-worker"
+WORKER_QUEUE_NAME="valro-worker-queue"
+WORKER_DLQ_NAME="valro-worker-dlq"
 API_ROLE_NAME="valro-lambda-role"
+LIVE_ALIAS="live"
+WORKER_PROVISIONED_CONCURRENCY="${WORKER_PROVISIONED_CONCURRENCY:-2}"
 WORKER_ROLE_NAME="valro-worker-role"
 
 # Check if deployment packages exist
@@ -34,6 +39,7 @@ echo "  Account ID: $ACCOUNT_ID"
 echo "  DynamoDB Table: $TABLE_NAME"
 echo "  API Lambda: $API_LAMBDA_NAME"
 echo "  Worker Lambda: $WORKER_LAMBDA_NAME"
+echo "  Worker Queue: $WORKER_QUEUE_NAME"
 echo ""
 
 # Prompt for Agent Runtime ARN
@@ -54,8 +60,13 @@ else
     echo "Creating DynamoDB table '$TABLE_NAME'..."
     aws dynamodb create-table \
         --table-name $TABLE_NAME \
-        --attribute-definitions AttributeName=id,AttributeType=S \
+        --attribute-definitions \
+            AttributeName=id,AttributeType=S \
+            AttributeName=entity_type,AttributeType=S \
+            AttributeName=created_at,AttributeType=S \
         --key-schema AttributeName=id,KeyType=HASH \
+        --global-secondary-indexes \
+            "IndexName=by_created_at,KeySchema=[{AttributeName=entity_type,KeyType=HASH},{AttributeName=created_at,KeyType=RANGE}],Projection={ProjectionType=ALL}" \
         --billing-mode PAY_PER_REQUEST \
         --region $AWS_REGION \
         --tags Key=Project,Value=Valro
@@ -65,9 +76,64 @@ else
     echo "✓ DynamoDB table created successfully"
 fi
 
+# Idempotency claims expire through TTL on expires_at
+if [ "$(aws dynamodb describe-time-to-live --table-name $TABLE_NAME --region $AWS_REGION --query TimeToLiveDescription.TimeToLiveStatus --output text)" = "ENABLED" ]; then
+    echo "✓ TTL already enabled on '$TABLE_NAME'"
+else
+    aws dynamodb update-time-to-live \
+        --table-name $TABLE_NAME \
+        --time-to-live-specification Enabled=true,AttributeName=expires_at \
+        --region $AWS_REGION >/dev/null
+    echo "✓ TTL enabled on '$TABLE_NAME' (expires_at)"
+fi
+
 echo ""
 echo "========================================="
-echo "Step 2: Creating IAM Roles"
+echo "Step 2: Creating SQS Worker Queue"
+echo "========================================="
+
+# Dead-letter queue for records the worker cannot process (kept 14 days)
+WORKER_DLQ_URL=$(aws sqs create-queue \
+    --queue-name $WORKER_DLQ_NAME \
+    --attributes MessageRetentionPeriod=1209600 \
+    --tags Project=Valro \
+    --region $AWS_REGION \
+    --query QueueUrl --output text)
+WORKER_DLQ_ARN=$(aws sqs get-queue-attributes \
+    --queue-url $WORKER_DLQ_URL \
+    --attribute-names QueueArn \
+    --region $AWS_REGION \
+    --query Attributes.QueueArn --output text)
+echo "✓ SQS dead-letter queue ready: $WORKER_DLQ_URL"
+
+# Visibility timeout must exceed the Worker Lambda timeout (600s)
+WORKER_QUEUE_URL=$(aws sqs create-queue \
+    --queue-name $WORKER_QUEUE_NAME \
+    --attributes VisibilityTimeout=3600 \
+    --tags Project=Valro \
+    --region $AWS_REGION \
+    --query QueueUrl --output text)
+WORKER_QUEUE_ARN=$(aws sqs get-queue-attributes \
+    --queue-url $WORKER_QUEUE_URL \
+    --attribute-names QueueArn \
+    --region $AWS_REGION \
+    --query Attributes.QueueArn --output text)
+
+# Set separately so existing queues pick it up (create-queue rejects changed attributes)
+cat > /tmp/worker-queue-redrive.json << EOF
+{
+  "RedrivePolicy": "{\"deadLetterTargetArn\":\"${WORKER_DLQ_ARN}\",\"maxReceiveCount\":\"3\"}"
+}
+EOF
+aws sqs set-queue-attributes \
+    --queue-url $WORKER_QUEUE_URL \
+    --attributes file:///tmp/worker-queue-redrive.json \
+    --region $AWS_REGION
+echo "✓ SQS queue ready: $WORKER_QUEUE_URL (dead-letters to $WORKER_DLQ_NAME after 3 receives)"
+
+echo ""
+echo "========================================="
+echo "Step 3: Creating IAM Roles"
 echo "========================================="
 
 # Create trust policy for Lambda
@@ -90,18 +156,16 @@ else
     aws iam create-role \
         --role-name $WORKER_ROLE_NAME \
         --assume-role-policy-document file:///tmp/lambda-trust-policy.json
-
-    echo "Attaching policy to Worker role..."
-    aws iam put-role-policy \
-        --role-name $WORKER_ROLE_NAME \
-        --policy-name ValroWorkerPolicy \
-        --policy-document file://worker-iam-policy.json
-
     echo "✓ Worker role created successfully"
-    echo "Waiting 10 seconds for role to propagate..."
-    sleep 10
 fi
 
+# Always (re)apply the policy so existing roles pick up new permissions
+echo "Attaching policy to Worker role..."
+aws iam put-role-policy \
+    --role-name $WORKER_ROLE_NAME \
+    --policy-name ValroWorkerPolicy \
+    --policy-document file://worker-iam-policy.json
+
 # Create API Lambda Role
 echo "Creating API Lambda IAM role..."
 if aws iam get-role --role-name $API_ROLE_NAME >/dev/null 2>&1; then
@@ -110,27 +174,45 @@ else
     aws iam create-role \
         --role-name $API_ROLE_NAME \
         --assume-role-policy-document file:///tmp/lambda-trust-policy.json
-
-    echo "Attaching policy to API role..."
-    aws iam put-role-policy \
-        --role-name $API_ROLE_NAME \
-        --policy-name ValroAPIPolicy \
-        --policy-document file://iam-policy.json
-
     echo "✓ API role created successfully"
-    echo "Waiting 10 seconds for role to propagate..."
-    sleep 10
 fi
 
+echo "Attaching policy to API role..."
+aws iam put-role-policy \
+    --role-name $API_ROLE_NAME \
+    --policy-name ValroAPIPolicy \
+    --policy-document file://iam-policy.json
+
+# New roles and policy changes must propagate before Lambda (and the SQS
+# event source mapping) can use them
+echo "Waiting 10 seconds for roles and policies to propagate..."
+sleep 10
+
 WORKER_ROLE_ARN="arn:aws:iam::${ACCOUNT_ID}:role/${WORKER_ROLE_NAME}"
 API_ROLE_ARN="arn:aws:iam::${ACCOUNT_ID}:role/${API_ROLE_NAME}"
-WORKER_LAMBDA_ARN="arn:aws:lambda:${AWS_REGION}:${ACCOUNT_ID}:function:${WORKER_LAMBDA_NAME}"
 
 echo ""
 echo "========================================="
-echo "Step 3: Creating Lambda Functions"
+echo "Step 4: Creating Lambda Functions"
 echo "========================================="
 
+# Publish the current code as a new version and point the live alias at it
+publish_live_alias() {
+    local function_name=$1
+    aws lambda wait function-active --function-name $function_name --region $AWS_REGION
+    aws lambda wait function-updated --function-name $function_name --region $AWS_REGION
+    local version=$(aws lambda publish-version \
+        --function-name $function_name \
+        --region $AWS_REGION \
+        --query Version --output text)
+    if aws lambda get-alias --function-name $function_name --name $LIVE_ALIAS --region $AWS_REGION >/dev/null 2>&1; then
+        aws lambda update-alias --function-name $function_name --name $LIVE_ALIAS --function-version $version --region $AWS_REGION >/dev/null
+    else
+        aws lambda create-alias --function-name $function_name --name $LIVE_ALIAS --function-version $version --region $AWS_REGION >/dev/null
+    fi
+    echo "✓ $function_name:$LIVE_ALIAS -> version $version"
+}
+
 # Create Worker Lambda
 echo "Creating Worker Lambda function..."
 if aws lambda get-function --function-name $WORKER_LAMBDA_NAME --region $AWS_REGION >/dev/null 2>&1; then
@@ -138,11 +220,14 @@ if aws lambda get-function --function-name $WORKER_LAMBDA_NAME --region $AWS_REG
     aws lambda update-function-code \
         --function-name $WORKER_LAMBDA_NAME \
         --zip-file fileb://valro-worker-lambda.zip \
+        --architectures arm64 \
         --region $AWS_REGION
+    aws lambda wait function-updated --function-name $WORKER_LAMBDA_NAME --region $AWS_REGION
 
     echo "Updating Worker Lambda configuration..."
     aws lambda update-function-configuration \
         --function-name $WORKER_LAMBDA_NAME \
+        --runtime python3.12 \
         --timeout 600 \
         --memory-size 1024 \
         --environment "Variables={DYNAMODB_TABLE_NAME=${TABLE_NAME},AGENT_RUNTIME_ARN=${AGENT_RUNTIME_ARN},AWS_REGION=${AWS_REGION}}" \
@@ -152,7 +237,8 @@ if aws lambda get-function --function-name $WORKER_LAMBDA_NAME --region $AWS_REG
 else
     aws lambda create-function \
         --function-name $WORKER_LAMBDA_NAME \
-        --runtime python3.11 \
+        --runtime python3.12 \
+        --architectures arm64 \
         --role $WORKER_ROLE_ARN \
         --handler worker_lambda.lambda_handler \
         --zip-file fileb://valro-worker-lambda.zip \
@@ -165,6 +251,36 @@ else
     echo "✓ Worker Lambda created successfully"
 fi
 
+# Publish a version behind the live alias and keep warm instances on it
+publish_live_alias $WORKER_LAMBDA_NAME
+echo "Setting provisioned concurrency ($WORKER_PROVISIONED_CONCURRENCY) on Worker Lambda..."
+aws lambda put-provisioned-concurrency-config \
+    --function-name $WORKER_LAMBDA_NAME \
+    --qualifier $LIVE_ALIAS \
+    --provisioned-concurrent-executions $WORKER_PROVISIONED_CONCURRENCY \
+    --region $AWS_REGION >/dev/null
+
+# Wire the queue to the Worker Lambda's live alias
+echo "Configuring SQS event source for Worker Lambda..."
+MAPPING_UUID=$(aws lambda list-event-source-mappings --function-name $WORKER_LAMBDA_NAME:$LIVE_ALIAS --event-source-arn $WORKER_QUEUE_ARN --region $AWS_REGION --query 'EventSourceMappings[0].UUID' --output text | grep -v None || true)
+if [ -n "$MAPPING_UUID" ]; then
+    # Mappings created before partial batch responses were reported
+    aws lambda update-event-source-mapping \
+        --uuid $MAPPING_UUID \
+        --function-response-types ReportBatchItemFailures \
+        --region $AWS_REGION >/dev/null
+    echo "✓ Event source mapping already exists (partial batch responses enabled)"
+else
+    aws lambda create-event-source-mapping \
+        --function-name $WORKER_LAMBDA_NAME:$LIVE_ALIAS \
+        --event-source-arn $WORKER_QUEUE_ARN \
+        --batch-size 10 \
+        --maximum-batching-window-in-seconds 1 \
+        --function-response-types ReportBatchItemFailures \
+        --region $AWS_REGION
+    echo "✓ Event source mapping created"
+fi
+
 # Create API Lambda
 echo ""
 echo "Creating API Lambda function..."
@@ -173,36 +289,45 @@ if aws lambda get-function --function-name $API_LAMBDA_NAME --region $AWS_REGION
     aws lambda update-function-code \
         --function-name $API_LAMBDA_NAME \
         --zip-file fileb://valro-api-lambda.zip \
+        --architectures arm64 \
         --region $AWS_REGION
+    aws lambda wait function-updated --function-name $API_LAMBDA_NAME --region $AWS_REGION
 
     echo "Updating API Lambda configuration..."
     aws lambda update-function-configuration \
         --function-name $API_LAMBDA_NAME \
+        --runtime python3.12 \
+        --snap-start ApplyOn=PublishedVersions \
         --timeout 30 \
         --memory-size 512 \
-        --environment "Variables={DYNAMODB_TABLE_NAME=${TABLE_NAME},WORKER_LAMBDA_ARN=${WORKER_LAMBDA_ARN},AWS_REGION=${AWS_REGION}}" \
+        --environment "Variables={DYNAMODB_TABLE_NAME=${TABLE_NAME},WORKER_QUEUE_URL=${WORKER_QUEUE_URL},AWS_REGION=${AWS_REGION}}" \
         --region $AWS_REGION
 
     echo "✓ API Lambda updated successfully"
 else
     aws lambda create-function \
         --function-name $API_LAMBDA_NAME \
-        --runtime python3.11 \
+        --runtime python3.12 \
+        --architectures arm64 \
         --role $API_ROLE_ARN \
         --handler lambda_function.lambda_handler \
         --zip-file fileb://valro-api-lambda.zip \
+        --snap-start ApplyOn=PublishedVersions \
         --timeout 30 \
         --memory-size 512 \
-        --environment "Variables={DYNAMODB_TABLE_NAME=${TABLE_NAME},WORKER_LAMBDA_ARN=${WORKER_LAMBDA_ARN},AWS_REGION=${AWS_REGION}}" \
+        --environment "Variables={DYNAMODB_TABLE_NAME=${TABLE_NAME},WORKER_QUEUE_URL=${WORKER_QUEUE_URL},AWS_REGION=${AWS_REGION}}" \
         --region $AWS_REGION \
         --tags Project=Valro
 
     echo "✓ API Lambda created successfully"
 fi
 
+# SnapStart snapshots are taken when a version is published
+publish_live_alias $API_LAMBDA_NAME
+
 echo ""
 echo "========================================="
-echo "Step 4: Checking API Gateway"
+echo "Step 5: Checking API Gateway"
 echo "========================================="
 
 echo "Note: API Gateway setup is not automated in this script."
@@ -210,7 +335,7 @@ echo "If you haven't created an API Gateway yet, please create one manually or u
 echo ""
 echo "Quick API Gateway setup:"
 echo "  1. Create HTTP API in API Gateway"
-echo "  2. Add integration to '$API_LAMBDA_NAME' Lambda"
+echo "  2. Add integration to the '$API_LAMBDA_NAME:$LIVE_ALIAS' alias (SnapStart only applies to published versions)"
 echo "  3. Create routes: POST /tasks, GET /tasks, GET /tasks/{id}"
 echo "  4. Enable CORS"
 echo "  5. Deploy to \$default stage"
@@ -236,13 +361,14 @@ echo ""
 echo "Resources Created:"
 echo "  ✓ DynamoDB Table: $TABLE_NAME"
 echo "  ✓ Worker Lambda: $WORKER_LAMBDA_NAME"
+echo "  ✓ SQS Queue: $WORKER_QUEUE_NAME (DLQ: $WORKER_DLQ_NAME)"
 echo "  ✓ API Lambda: $API_LAMBDA_NAME"
 echo "  ✓ IAM Roles: $WORKER_ROLE_NAME, $API_ROLE_NAME"
 echo ""
 echo "Environment Variables Set:"
 echo "  API Lambda:"
 echo "    - DYNAMODB_TABLE_NAME=$TABLE_NAME"
-echo "    - WORKER_LAMBDA_ARN=$WORKER_LAMBDA_ARN"
+echo "    - WORKER_QUEUE_URL=$WORKER_QUEUE_URL"
 echo "    - AWS_REGION=$AWS_REGION"
 echo ""
 echo "  Worker Lambda:"
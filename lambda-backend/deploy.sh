@@ -25,21 +25,26 @@ echo "Step 2: Installing dependencies..."
 mkdir -p $API_PACKAGE_DIR
 mkdir -p $WORKER_PACKAGE_DIR
 
+# orjson ships native wheels, so install the Lambda runtime's (arm64) build rather than the host's
+PIP_PLATFORM_ARGS="--platform manylinux2014_aarch64 --python-version 3.12 --implementation cp --only-binary=:all:"
+
 echo "  Installing dependencies for API Lambda..."
-pip3 install -r requirements.txt -t $API_PACKAGE_DIR/ --quiet
+pip3 install -r requirements.txt -t $API_PACKAGE_DIR/ $PIP_PLATFORM_ARGS --quiet
 
 echo "  Installing dependencies for Worker Lambda..."
-pip3 install -r requirements.txt -t $WORKER_PACKAGE_DIR/ --quiet
+pip3 install -r requirements.txt -t $WORKER_PACKAGE_DIR/ $PIP_PLATFORM_ARGS --quiet
 
 echo ""
 echo "Step 3: Adding Lambda function code..."
 
 echo "  Packaging API Lambda..."
 cp lambda_function.py $API_PACKAGE_DIR/
+cp aws_clients.py $API_PACKAGE_DIR/
 cp dynamodb_helpers.py $API_PACKAGE_DIR/
 
 echo "  Packaging Worker Lambda..."
 cp worker_lambda.py $WORKER_PACKAGE_DIR/
+cp aws_clients.py $WORKER_PACKAGE_DIR/
 cp dynamodb_helpers.py $WORKER_PACKAGE_DIR/
 
 echo ""
@@ -70,14 +75,16 @@ echo ""
 echo "2. Create DynamoDB table:"
 echo "   aws dynamodb create-table \\"
 echo "     --table-name valro-tasks \\"
-echo "     --attribute-definitions AttributeName=id,AttributeType=S \\"
+echo "     --attribute-definitions AttributeName=id,AttributeType=S AttributeName=entity_type,AttributeType=S AttributeName=created_at,AttributeType=S \\"
 echo "     --key-schema AttributeName=id,KeyType=HASH \\"
+echo "     --global-secondary-indexes 'IndexName=by_created_at,KeySchema=[{AttributeName=entity_type,KeyType=HASH},{AttributeName=created_at,KeyType=RANGE}],Projection={ProjectionType=ALL}' \\"
 echo "     --billing-mode PAY_PER_REQUEST"
 echo ""
 echo "3. Create Worker Lambda:"
 echo "   aws lambda create-function \\"
 echo "     --function-name valro-worker \\"
-echo "     --runtime python3.11 \\"
+echo "     --runtime python3.12 \\"
+echo "     --architectures arm64 \\"
 echo "     --role arn:aws:iam::YOUR_ACCOUNT:role/valro-worker-role \\"
 echo "     --handler worker_lambda.lambda_handler \\"
 echo "     --zip-file fileb://valro-worker-lambda.zip \\"
@@ -85,19 +92,29 @@ echo "     --timeout 600 \\"
 echo "     --memory-size 1024 \\"
 echo "     --environment Variables='{DYNAMODB_TABLE_NAME=valro-tasks,AGENT_RUNTIME_ARN=YOUR_ARN,AWS_REGION=us-east-1}'"
 echo ""
+echo "   Create the worker queue and connect it to the Worker Lambda:"
+echo "   aws sqs create-queue --queue-name valro-worker-queue --attributes VisibilityTimeout=3600"
+echo "   aws lambda create-event-source-mapping \\"
+echo "     --function-name valro-worker \\"
+echo "     --event-source-arn arn:aws:sqs:REGION:ACCOUNT:valro-worker-queue \\"
+echo "     --batch-size 10 \\"
+echo "     --maximum-batching-window-in-seconds 1"
+echo ""
 echo "4. Create API Lambda:"
 echo "   aws lambda create-function \\"
 echo "     --function-name valro-backend \\"
-echo "     --runtime python3.11 \\"
+echo "     --runtime python3.12 \\"
+echo "     --architectures arm64 \\"
 echo "     --role arn:aws:iam::YOUR_ACCOUNT:role/valro-lambda-role \\"
 echo "     --handler lambda_function.lambda_handler \\"
 echo "     --zip-file fileb://valro-api-lambda.zip \\"
+echo "     --snap-start ApplyOn=PublishedVersions \\"
 echo "     --timeout 30 \\"
 echo "     --memory-size 512 \\"
-echo "     --environment Variables='{DYNAMODB_TABLE_NAME=valro-tasks,WORKER_LAMBDA_ARN=arn:aws:lambda:REGION:ACCOUNT:function:valro-worker,AWS_REGION=us-east-1}'"
+echo "     --environment Variables='{DYNAMODB_TABLE_NAME=valro-tasks,WORKER_QUEUE_URL=https://sqs.REGION.amazonaws.com/ACCOUNT/valro-worker-queue,AWS_REGION=us-east-1}'"
 echo ""
 echo "5. Or update existing functions:"
-echo "   aws lambda update-function-code --function-name valro-backend --zip-file fileb://valro-api-lambda.zip"
-echo "   aws lambda update-function-code --function-name valro-worker --zip-file fileb://valro-worker-lambda.zip"
+echo "   aws lambda update-function-code --function-name valro-backend --zip-file fileb://valro-api-lambda.zip --architectures arm64"
+echo "   aws lambda update-function-code --function-name valro-worker --zip-file fileb://valro-worker-lambda.zip --architectures arm64"
 echo ""
 echo "========================================="
@@ -2,20 +2,37 @@
 DynamoDB Helper Functions for Valro Task Management
 Shared utilities for both API and Worker Lambdas
 """
-import os
+import time
 from datetime import datetime, timezone
 from decimal import Decimal
-import boto3
 from boto3.dynamodb.conditions import Key, Attr
+from aws_clients import TABLE_NAME, get_dynamodb, get_table as _get_table
 
-# Initialize DynamoDB resource
-dynamodb = boto3.resource('dynamodb', region_name=os.environ.get('AWS_REGION', 'us-east-1'))
-TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'valro-tasks')
+# Keep only the most recent events on the task item so its size (and WCU/RCU cost) stays flat
+MAX_TASK_EVENTS = 50
+
+# batch_get_item accepts at most 100 keys per request
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_RETRIES = 5
+
+# GSI used to list tasks newest-first without scanning the table
+CREATED_AT_INDEX = 'by_created_at'
+TASK_ENTITY_TYPE = 'task'
+
+# Idempotency claims share the table under this ID prefix; expires_at is the table's TTL attribute
+IDEMPOTENCY_KEY_PREFIX = 'idem#'
+
+_UTC = timezone.utc
+
+
+def now_iso():
+    """Current UTC time as an ISO 8601 string, the format used for every task timestamp"""
+    return datetime.now(_UTC).isoformat()
 
 
 def get_table():
     """Get DynamoDB table reference"""
-    return dynamodb.Table(TABLE_NAME)
+    return _get_table()
 
 
 def create_task(task):
@@ -30,19 +47,63 @@ def create_task(task):
     """
     table = get_table()
 
-    # Convert datetime objects to ISO strings if needed
-    task_copy = _prepare_item_for_dynamodb(task)
+    # Convert floats to Decimal only when the task actually contains any
+    item = _prepare_item_for_dynamodb(task) if _contains_float(task) else task
 
-    table.put_item(Item=task_copy)
+    table.put_item(Item={**item, 'entity_type': TASK_ENTITY_TYPE})
     return task
 
 
-def get_task(task_id):
+def claim_idempotency_key(idem_key, task_id, ttl_seconds, replace_task_id=None):
+    """
+    Point an idempotency key at a task unless a live claim already holds it
+
+    Claims are separate items (no entity_type, so they stay out of the
+    created_at GSI) that expire after ttl_seconds.
+
+    Args:
+        idem_key (str): Idempotency key
+        task_id (str): Task ID the key should point at
+        ttl_seconds (int): How long the claim lasts
+        replace_task_id (str, optional): Take over a live claim that points at this task
+
+    Returns:
+        str: None if the key was claimed, otherwise the task ID the current claim points at
+    """
+    table = get_table()
+    now = int(time.time())
+
+    condition_expression = 'attribute_not_exists(id) OR expires_at < :now'
+    expression_values = {':now': now}
+    if replace_task_id:
+        condition_expression += ' OR task_id = :replace_task_id'
+        expression_values[':replace_task_id'] = replace_task_id
+
+    try:
+        table.put_item(
+            Item={
+                'id': IDEMPOTENCY_KEY_PREFIX + idem_key,
+                'task_id': task_id,
+                'expires_at': now + ttl_seconds
+            },
+            ConditionExpression=condition_expression,
+            ExpressionAttributeValues=expression_values,
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        return None
+    except table.meta.client.exceptions.ConditionalCheckFailedException as e:
+        # The old item comes back in low-level attribute format
+        return e.response.get('Item', {}).get('task_id', {}).get('S', '')
+
+
+def get_task(task_id, consistent=False):
     """
     Get a task by ID
 
     Args:
         task_id (str): Task ID
+        consistent (bool): Strongly consistent read (2x the RCUs); only needed
+            to observe a write made moments earlier
 
     Returns:
         dict: Task object or None if not found
@@ -50,14 +111,55 @@ def get_task(task_id):
     table = get_table()
 
     try:
-        response = table.get_item(Key={'id': task_id})
+        response = table.get_item(Key={'id': task_id}, ConsistentRead=consistent)
         return response.get('Item')
     except Exception as e:
         print(f"Error getting task {task_id}: {e}")
         return None
 
 
-def update_task_status(task_id, status, error_message=None):
+def get_tasks_bulk(task_ids):
+    """
+    Get many tasks by ID with batch_get_item (up to 100 keys per request)
+
+    Args:
+        task_ids (list): Task IDs (duplicates are fetched once)
+
+    Returns:
+        list: Task objects that were found (order is not preserved)
+    """
+    tasks = []
+
+    # BatchGetItem rejects requests with duplicate keys, so dedupe (keeping order) first
+    task_ids = list(dict.fromkeys(task_ids))
+
+    for start in range(0, len(task_ids), BATCH_GET_MAX_KEYS):
+        request_items = {
+            TABLE_NAME: {'Keys': [{'id': task_id} for task_id in task_ids[start:start + BATCH_GET_MAX_KEYS]]}
+        }
+
+        # Retry throttled keys with exponential backoff
+        attempt = 0
+        while request_items:
+            if attempt:
+                if attempt > BATCH_GET_MAX_RETRIES:
+                    raise RuntimeError(f"Unprocessed keys remained after {BATCH_GET_MAX_RETRIES} retries")
+                time.sleep(0.05 * 2 ** (attempt - 1))
+
+            try:
+                response = get_dynamodb().batch_get_item(RequestItems=request_items)
+            except Exception as e:
+                print(f"Error batch getting tasks: {e}")
+                raise
+
+            tasks.extend(response.get('Responses', {}).get(TABLE_NAME, []))
+            request_items = response.get('UnprocessedKeys') or {}
+            attempt += 1
+
+    return tasks
+
+
+def update_task_status(task_id, status, error_message=None, now=None, events=None, expected_status=None):
     """
     Update task status
 
@@ -65,16 +167,24 @@ def update_task_status(task_id, status, error_message=None):
         task_id (str): Task ID
         status (str): New status (pending, processing, completed, error)
         error_message (str, optional): Error message if status is 'error'
+        now (str, optional): ISO timestamp to use, so callers can share one per request
+        events (list, optional): Events to append in the same write, as (message, event_type) tuples
+        expected_status (str, optional): Only update a task currently in this status
 
     Returns:
         dict: Updated task
+
+    Raises:
+        ClientError: ConditionalCheckFailedException if the task does not exist or is not
+            in expected_status; the error response carries the current 'Item' when it exists
     """
     table = get_table()
+    now = now or now_iso()
 
     update_expression = "SET #status = :status, updated_at = :updated_at"
     expression_values = {
         ':status': status,
-        ':updated_at': datetime.now(timezone.utc).isoformat()
+        ':updated_at': now
     }
     expression_names = {
         '#status': 'status'  # 'status' might be a reserved word
@@ -84,77 +194,108 @@ def update_task_status(task_id, status, error_message=None):
         update_expression += ", error_message = :error_message"
         expression_values[':error_message'] = error_message
 
+    if events:
+        update_expression += ", events = list_append(if_not_exists(events, :empty_list), :events)"
+        expression_values[':events'] = [
+            {'ts': now, 'message': message, 'type': event_type}
+            for message, event_type in events
+        ]
+        expression_values[':empty_list'] = []
+
+    condition_expression = 'attribute_exists(id)'
+    if expected_status:
+        condition_expression += ' AND #status = :expected_status'
+        expression_values[':expected_status'] = expected_status
+
     try:
         response = table.update_item(
             Key={'id': task_id},
             UpdateExpression=update_expression,
+            ConditionExpression=condition_expression,
             ExpressionAttributeValues=expression_values,
             ExpressionAttributeNames=expression_names,
-            ReturnValues='ALL_NEW'
+            ReturnValues='ALL_NEW',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
         )
-        return response.get('Attributes')
+        return _trim_events(table, task_id, response.get('Attributes'))
     except Exception as e:
         print(f"Error updating task status for {task_id}: {e}")
         raise
 
 
-def add_task_event(task_id, message, event_type="info"):
+def set_task_progress(task_id, chunks, now=None):
     """
-    Add an event to the task's event timeline
+    Record how many response chunks the agent has streamed so far
+
+    Overwrites a single attribute rather than appending to the event
+    timeline, so long responses never push lifecycle events out of it.
 
     Args:
         task_id (str): Task ID
-        message (str): Event message
-        event_type (str): Event type (info, success, error)
+        chunks (int): Chunks received so far
+        now (str, optional): ISO timestamp to use, so callers can share one per request
 
     Returns:
         dict: Updated task
+
+    Raises:
+        ClientError: ConditionalCheckFailedException if the task does not exist
     """
     table = get_table()
 
-    event = {
-        'ts': datetime.now(timezone.utc).isoformat(),
-        'message': message,
-        'type': event_type
-    }
-
     try:
         response = table.update_item(
             Key={'id': task_id},
-            UpdateExpression="SET events = list_append(if_not_exists(events, :empty_list), :event), updated_at = :updated_at",
+            UpdateExpression="SET progress_chunks = :chunks, updated_at = :updated_at",
+            ConditionExpression='attribute_exists(id)',
             ExpressionAttributeValues={
-                ':event': [event],
-                ':empty_list': [],
-                ':updated_at': datetime.now(timezone.utc).isoformat()
+                ':chunks': chunks,
+                ':updated_at': now or now_iso()
             },
             ReturnValues='ALL_NEW'
         )
         return response.get('Attributes')
     except Exception as e:
-        print(f"Error adding event to task {task_id}: {e}")
+        print(f"Error updating progress for task {task_id}: {e}")
         raise
 
 
-def update_task_with_agent_response(task_id, agent_response, vendors=None, emails_sent=0):
+def finalize_task(task_id, status, agent_response, vendors=None, emails_sent=0, events=None, now=None):
     """
-    Update task with agent response and results
+    Record the agent's results, final status and closing events in a single write
 
     Args:
         task_id (str): Task ID
+        status (str): Final status (completed, error)
         agent_response (str): Agent's response text
         vendors (list, optional): List of vendors contacted
         emails_sent (int): Number of emails sent
+        events (list, optional): Events to append to the timeline, as (message, event_type) tuples
+        now (str, optional): ISO timestamp to use, so callers can share one per request
 
     Returns:
         dict: Updated task
+
+    Raises:
+        ClientError: ConditionalCheckFailedException if the task does not exist
     """
     table = get_table()
+    now = now or now_iso()
 
-    update_expression = "SET agent_response = :agent_response, emails_sent = :emails_sent, updated_at = :updated_at"
+    update_expression = (
+        "SET #status = :status, agent_response = :agent_response, emails_sent = :emails_sent, "
+        "events = list_append(if_not_exists(events, :empty_list), :events), updated_at = :updated_at"
+    )
     expression_values = {
+        ':status': status,
         ':agent_response': agent_response,
         ':emails_sent': emails_sent,
-        ':updated_at': datetime.now(timezone.utc).isoformat()
+        ':events': [
+            {'ts': now, 'message': message, 'type': event_type}
+            for message, event_type in (events or [])
+        ],
+        ':empty_list': [],
+        ':updated_at': now
     }
 
     if vendors:
@@ -165,18 +306,58 @@ def update_task_with_agent_response(task_id, agent_response, vendors=None, email
         response = table.update_item(
             Key={'id': task_id},
             UpdateExpression=update_expression,
+            ConditionExpression='attribute_exists(id)',
             ExpressionAttributeValues=expression_values,
+            ExpressionAttributeNames={'#status': 'status'},
             ReturnValues='ALL_NEW'
         )
-        return response.get('Attributes')
+        return _trim_events(table, task_id, response.get('Attributes'))
     except Exception as e:
-        print(f"Error updating task with agent response for {task_id}: {e}")
+        print(f"Error finalizing task {task_id}: {e}")
         raise
 
 
+def _trim_events(table, task_id, attributes):
+    """
+    Drop the oldest events once a task holds more than MAX_TASK_EVENTS
+
+    Removes by index from the head of the list, so events appended
+    concurrently at the tail are unaffected.
+
+    Args:
+        table: DynamoDB table
+        task_id (str): Task ID
+        attributes (dict): Task attributes returned by the append
+
+    Returns:
+        dict: Task attributes after trimming
+    """
+    events = (attributes or {}).get('events', [])
+    overflow = len(events) - MAX_TASK_EVENTS
+    if overflow <= 0:
+        return attributes
+
+    try:
+        response = table.update_item(
+            Key={'id': task_id},
+            UpdateExpression="REMOVE " + ", ".join(f"events[{i}]" for i in range(overflow)),
+            ConditionExpression="size(events) > :max_events",
+            ExpressionAttributeValues={':max_events': MAX_TASK_EVENTS},
+            ReturnValues='ALL_NEW'
+        )
+        return response.get('Attributes')
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        # Another writer already trimmed the list
+        return attributes
+    except Exception as e:
+        # Best-effort: the write that appended the events has already succeeded
+        print(f"Error trimming events for task {task_id}: {e}")
+        return attributes
+
+
 def list_tasks(limit=50, last_evaluated_key=None):
     """
-    List all tasks with pagination
+    List tasks newest-first with pagination, via the created_at GSI
 
     Args:
         limit (int): Maximum number of tasks to return
@@ -190,23 +371,21 @@ def list_tasks(limit=50, last_evaluated_key=None):
     """
     table = get_table()
 
-    scan_kwargs = {
+    query_kwargs = {
+        'IndexName': CREATED_AT_INDEX,
+        'KeyConditionExpression': Key('entity_type').eq(TASK_ENTITY_TYPE),
+        'ScanIndexForward': False,  # Newest first
         'Limit': limit
     }
 
     if last_evaluated_key:
-        scan_kwargs['ExclusiveStartKey'] = last_evaluated_key
+        query_kwargs['ExclusiveStartKey'] = last_evaluated_key
 
     try:
-        response = table.scan(**scan_kwargs)
-
-        tasks = response.get('Items', [])
-
-        # Sort by created_at descending (newest first)
-        tasks.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+        response = table.query(**query_kwargs)
 
         return {
-            'tasks': tasks,
+            'tasks': response.get('Items', []),
             'last_evaluated_key': response.get('LastEvaluatedKey')
         }
     except Exception as e:
@@ -214,6 +393,28 @@ def list_tasks(limit=50, last_evaluated_key=None):
         raise
 
 
+def _contains_float(obj):
+    """
+    Check whether a nested dict/list structure contains any float
+
+    Args:
+        obj: Value to inspect
+
+    Returns:
+        bool: True on the first float found
+    """
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            return True
+        if isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return False
+
+
 def _prepare_item_for_dynamodb(item):
     """
     Prepare an item for DynamoDB by converting incompatible types
@@ -229,6 +430,6 @@ def _prepare_item_for_dynamodb(item):
     elif isinstance(item, list):
         return [_prepare_item_for_dynamodb(v) for v in item]
     elif isinstance(item, float):
-        return Decimal(str(item))
+        return Decimal(repr(item))
     else:
         return item
@@ -3,25 +3,90 @@ Valro Lambda Backend - API Handler
 Serverless API for managing home service tasks with AgentCore integration
 Now with asynchronous processing and DynamoDB persistence
 """
+import hashlib
 import json
 import os
+import re
 import uuid
-from datetime import datetime, timezone
-import boto3
+from decimal import Decimal
+import orjson
+
+try:
+    from snapshot_restore_py import register_after_restore
+except ImportError:
+    # Only provided by the Lambda Python runtime (SnapStart); a no-op elsewhere
+    def register_after_restore(func):
+        return func
+
+from aws_clients import get_sqs, get_table, reset_clients
 from dynamodb_helpers import (
+    IDEMPOTENCY_KEY_PREFIX,
+    claim_idempotency_key,
     create_task,
     get_task,
     list_tasks,
-    add_task_event
+    now_iso,
+    update_task_status
 )
 
-# AWS clients
-lambda_client = boto3.client('lambda', region_name=os.environ.get("AWS_REGION", "us-east-1"))
-
 # Environment variables
-WORKER_LAMBDA_ARN = os.environ.get("WORKER_LAMBDA_ARN")
-if not WORKER_LAMBDA_ARN:
-    print("WARNING: WORKER_LAMBDA_ARN not set")
+WORKER_QUEUE_URL = os.environ.get("WORKER_QUEUE_URL")
+if not WORKER_QUEUE_URL:
+    print("WARNING: WORKER_QUEUE_URL not set")
+WORKER_QUEUE_IS_FIFO = bool(WORKER_QUEUE_URL) and WORKER_QUEUE_URL.endswith(".fifo")
+
+# How long an identical submission from the same caller is coalesced into the
+# in-flight task it duplicates (the lifetime of its idempotency claim)
+IDEMPOTENCY_WINDOW_SECONDS = int(os.environ.get("IDEMPOTENCY_WINDOW_SECONDS", "300"))
+_IN_FLIGHT_STATUSES = ("pending", "processing")
+
+# Full event dumps, evaluated once per container
+_DEBUG_EVENTS = bool(os.environ.get("DEBUG_EVENTS"))
+
+# Matches /tasks and /tasks/{id}, with an optional trailing slash
+_TASKS_RE = re.compile(r'^/tasks(?:/(?P<id>[^/]+))?/?$')
+
+# Identical on every response, so built once per container
+_CORS_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET,POST,OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
+}
+
+_WARMED = False
+
+
+def _prewarm():
+    """Build clients and open the DynamoDB and SQS connections during init so the first request skips both"""
+    global _WARMED
+    if _WARMED:
+        return
+    table = get_table()
+    try:
+        table.meta.client.describe_table(TableName=table.name)
+    except Exception:
+        # Even a denied call leaves a pooled, handshaken connection behind
+        pass
+    if not WORKER_QUEUE_URL:
+        return
+    try:
+        get_sqs().get_queue_attributes(QueueUrl=WORKER_QUEUE_URL, AttributeNames=['QueueArn'])
+    except Exception:
+        pass
+    _WARMED = True
+
+
+@register_after_restore
+def _after_restore():
+    """Rebuild clients after a SnapStart restore so no snapshotted socket is reused"""
+    global _WARMED
+    reset_clients()
+    _WARMED = False
+    _prewarm()
+
+
+_prewarm()
 
 
 def lambda_handler(event, context):
@@ -32,40 +97,63 @@ def lambda_handler(event, context):
     - GET /tasks - List all tasks
     - GET /tasks/{id} - Get specific task details
     """
-    print(f"Received event: {json.dumps(event)}")
+    if _DEBUG_EVENTS:
+        print(f"Received event: {orjson.dumps(event).decode()}")
 
     method = event.get("httpMethod") or event.get("requestContext", {}).get("http", {}).get("method")
     raw_path = event.get("path") or event.get("rawPath", "")
+    print(f"method={method} path={raw_path} req_id={getattr(context, 'aws_request_id', None)}")
 
     # Handle CORS preflight
     if method == "OPTIONS":
         return _cors_response(200, {"ok": True})
 
     # Route handling
-    if method == "POST" and raw_path == "/tasks":
-        return handle_create_task(event)
+    match = _TASKS_RE.match(raw_path)
+    if match:
+        task_id = match.group("id")
+
+        if method == "POST" and not task_id:
+            return handle_create_task(event, now=now_iso())
 
-    if method == "GET" and raw_path == "/tasks":
-        return handle_list_tasks()
+        if method == "GET" and not task_id:
+            return handle_list_tasks()
 
-    if method == "GET" and raw_path.startswith("/tasks/"):
-        task_id = raw_path.split("/")[-1]
-        return handle_get_task(task_id)
+        if method == "GET":
+            return handle_get_task(task_id)
 
     return _cors_response(404, {"error": "Not found", "path": raw_path, "method": method})
 
 
-def handle_create_task(event):
-    """Create a new task and invoke Worker Lambda asynchronously"""
+def handle_create_task(event, now=None):
+    """Create a new task and queue it for the Worker Lambda"""
+    now = now or now_iso()
     try:
-        body = json.loads(event.get("body") or "{}")
+        body = orjson.loads(event.get("body") or "{}")
         description = body.get("description", "")
 
         if not description:
             return _cors_response(400, {"error": "Description is required"})
 
-        # Create task with pending status
+        # Coalesce a retried or double-clicked submission into the task it duplicates
+        # while that task is still in flight
+        idem_key = _idempotency_key(event, description)
         task_id = str(uuid.uuid4())
+        holder_id = claim_idempotency_key(idem_key, task_id, IDEMPOTENCY_WINDOW_SECONDS)
+        if holder_id is not None:
+            # The original was written moments ago (or is still being written), so read it consistently
+            holder = get_task(holder_id, consistent=True)
+            if holder is None or holder.get("status") in _IN_FLIGHT_STATUSES:
+                return _duplicate_response(holder or {"id": holder_id})
+
+            # The earlier task already finished or failed, so this is a new request
+            new_holder_id = claim_idempotency_key(
+                idem_key, task_id, IDEMPOTENCY_WINDOW_SECONDS, replace_task_id=holder_id
+            )
+            if new_holder_id is not None:
+                # A concurrent duplicate took the key over first
+                return _duplicate_response({"id": new_holder_id})
+
         task = {
             "id": task_id,
             "description": description,
@@ -73,45 +161,55 @@ def handle_create_task(event):
             "vendors": [],
             "quotes": [],
             "emails_sent": 0,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "created_at": now,
+            "updated_at": now,
             "events": [
                 {
-                    "ts": datetime.now(timezone.utc).isoformat(),
+                    "ts": now,
                     "message": "Task created",
                     "type": "info"
+                },
+                {
+                    "ts": now,
+                    "message": "Agent queued for processing",
+                    "type": "info"
                 }
             ],
         }
 
-        # Save task to DynamoDB
+        # Save task to DynamoDB (initial events included, so this is the only task write)
         create_task(task)
         print(f"Task {task_id} created in DynamoDB")
 
-        # Invoke Worker Lambda asynchronously
+        # Enqueue for the Worker Lambda (SQS event source)
         try:
             worker_payload = {
                 "task_id": task_id,
                 "description": description
             }
 
-            response = lambda_client.invoke(
-                FunctionName=WORKER_LAMBDA_ARN,
-                InvocationType='Event',  # Asynchronous invocation
-                Payload=json.dumps(worker_payload)
-            )
+            message = {
+                "QueueUrl": WORKER_QUEUE_URL,
+                "MessageBody": orjson.dumps(worker_payload).decode()
+            }
+            if WORKER_QUEUE_IS_FIFO:
+                # One group per task keeps tasks independent; the ID dedups enqueue retries
+                message["MessageGroupId"] = task_id
+                message["MessageDeduplicationId"] = task_id
 
-            print(f"Worker Lambda invoked: StatusCode={response.get('StatusCode')}")
+            response = get_sqs().send_message(**message)
 
-            # Add event for successful worker invocation
-            add_task_event(task_id, "Worker Lambda invoked - processing started", "info")
+            print(f"Worker message queued: MessageId={response.get('MessageId')}")
 
         except Exception as e:
-            print(f"Error invoking Worker Lambda: {e}")
+            print(f"Error queueing task for Worker Lambda: {e}")
             # Update task status to error in DynamoDB
-            from dynamodb_helpers import update_task_status
-            update_task_status(task_id, "error", error_message=f"Failed to invoke worker: {str(e)}")
-            add_task_event(task_id, f"Error invoking worker: {str(e)}", "error")
+            update_task_status(
+                task_id,
+                "error",
+                error_message=f"Failed to queue worker: {str(e)}",
+                events=[(f"Error queueing worker: {str(e)}", "error")]
+            )
 
             return _cors_response(500, {
                 "id": task_id,
@@ -131,6 +229,34 @@ def handle_create_task(event):
         return _cors_response(500, {"error": f"Internal server error: {str(e)}"})
 
 
+def _duplicate_response(existing):
+    """Return an already-submitted task instead of creating and queueing another"""
+    print(f"Duplicate submission for task {existing['id']}, not queueing again")
+    return _cors_response(202, {
+        "id": existing["id"],
+        "status": existing.get("status", "pending"),
+        "message": "Task already submitted"
+    })
+
+
+def _idempotency_key(event, description):
+    """
+    Hash the caller's identity and the description into an idempotency key
+
+    The caller is the authorizer's subject when the API has one, otherwise the
+    source IP and user agent (narrowing collisions between users behind one NAT).
+    """
+    request_context = event.get("requestContext") or {}
+    authorizer = request_context.get("authorizer") or {}
+    claims = (authorizer.get("jwt") or {}).get("claims") or authorizer.get("claims") or {}
+    caller = claims.get("sub")
+    if not caller:
+        http = request_context.get("http") or request_context.get("identity") or {}
+        user_agent = http.get("userAgent") or (event.get("headers") or {}).get("user-agent", "")
+        caller = f"{http.get('sourceIp', '')}|{user_agent}"
+    return hashlib.sha256(f"{caller}\n{description}".encode()).hexdigest()
+
+
 def handle_list_tasks():
     """Return all tasks from DynamoDB"""
     try:
@@ -149,7 +275,8 @@ def handle_get_task(task_id):
     """Get a specific task by ID from DynamoDB"""
     try:
         task = get_task(task_id)
-        if not task:
+        # Idempotency claims live in the same table but are not tasks
+        if not task or task_id.startswith(IDEMPOTENCY_KEY_PREFIX):
             return _cors_response(404, {"error": "Task not found", "task_id": task_id})
 
         print(f"Retrieved task {task_id} with status: {task.get('status')}")
@@ -163,16 +290,18 @@ def _cors_response(status_code: int, body):
     """Generate CORS-enabled API Gateway response"""
     return {
         "statusCode": status_code,
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET,POST,OPTIONS",
-            "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
-        },
-        "body": json.dumps(body, default=str)
+        "headers": _CORS_HEADERS,
+        "body": orjson.dumps(body, default=_json_default).decode()
     }
 
 
+def _json_default(obj):
+    """Serialize DynamoDB Decimals; orjson handles everything else natively"""
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
 # For local testing
 if __name__ == "__main__":
     print("=== Valro API Lambda Local Test ===")
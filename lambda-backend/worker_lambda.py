@@ -4,19 +4,17 @@ Handles asynchronous agent processing for home service tasks
 """
 import json
 import os
-from datetime import datetime, timezone
-import boto3
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+from botocore.exceptions import ClientError
+from aws_clients import get_bedrock_agentcore
 from dynamodb_helpers import (
-    get_task,
     update_task_status,
-    add_task_event,
-    update_task_with_agent_response
-)
-
-# AWS clients
-bedrock_agentcore_client = boto3.client(
-    "bedrock-agentcore",
-    region_name=os.environ.get("AWS_REGION", "us-east-1")
+    set_task_progress,
+    finalize_task
 )
 
 # AgentCore configuration from environment variables
@@ -24,90 +22,231 @@ AGENT_RUNTIME_ARN = os.environ.get("AGENT_RUNTIME_ARN")
 if not AGENT_RUNTIME_ARN:
     print("WARNING: AGENT_RUNTIME_ARN not set")
 
+# Verbose agent request/response logging and full event dumps, evaluated once per container
+_DEBUG = os.environ.get("LOG_LEVEL") == "DEBUG"
+_DEBUG_EVENTS = bool(os.environ.get("DEBUG_EVENTS"))
+
+# Cap on how much of a non-streamed agent response body is logged
+RESPONSE_LOG_MAX_BYTES = 500
+
+# Update the task's progress_chunks every N streamed chunks
+STREAM_PROGRESS_INTERVAL = int(os.environ.get("STREAM_PROGRESS_INTERVAL", "25"))
+
+# Per-container cache of agent responses keyed by normalized description.
+# Opt-in, and only runs that sent no outreach emails are cached, so a hit never
+# stands in for outreach this task did not get.
+AGENT_RESPONSE_CACHE = os.environ.get("AGENT_RESPONSE_CACHE") == "1"
+RESPONSE_CACHE_MAX = 512
+CACHED_RESPONSE_NOTE = "(Served from a previous identical request; no vendors were contacted for this task.)"
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
 
 def lambda_handler(event, context):
     """
-    Worker Lambda handler - invoked asynchronously by API Lambda
+    Worker Lambda handler - consumes the worker SQS queue
 
-    Expected event format:
+    Expected event format (SQS batch, one task per record):
     {
-        "task_id": "uuid",
-        "description": "user's task description"
+        "Records": [
+            {"body": "{\"task_id\": \"uuid\", \"description\": \"user's task description\"}"}
+        ]
     }
+
+    A bare {"task_id": ..., "description": ...} payload is also accepted for
+    direct invocation.
+    """
+    if _DEBUG_EVENTS:
+        print(f"Worker Lambda invoked with event: {orjson.dumps(event).decode()}")
+
+    records = event.get('Records')
+    print(f"records={len(records) if records is not None else 'direct'} req_id={getattr(context, 'aws_request_id', None)}")
+    if records is None:
+        return process_task(event)
+
+    # Records in a batch are independent agent runs, so process them concurrently
+    with ThreadPoolExecutor(max_workers=len(records)) as executor:
+        failed_ids = [message_id for message_id in executor.map(_process_record, records) if message_id]
+
+    print(f"Processed batch of {len(records)} tasks ({len(failed_ids)} failed)")
+
+    # Only unusable records are retried (and then dead-lettered); agent errors are
+    # recorded on the task itself, and redelivered records for claimed tasks are skipped
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_ids]}
+
+
+def _process_record(record):
+    """
+    Process one SQS record without letting it fail the rest of the batch
+
+    Args:
+        record (dict): SQS record whose body is the task payload
+
+    Returns:
+        str: The record's messageId if it should be retried, otherwise None
+    """
+    message_id = record.get('messageId')
+    try:
+        payload = orjson.loads(record['body'])
+        if not isinstance(payload, dict):
+            raise ValueError(f"Expected a JSON object, got {type(payload).__name__}")
+        result = process_task(payload)
+    except Exception as e:
+        print(f"ERROR processing record {message_id}: {e}")
+        return message_id
+
+    return message_id if result.get('statusCode') == 400 else None
+
+
+def process_task(payload):
     """
-    print(f"Worker Lambda invoked with event: {json.dumps(event)}")
+    Run the agent for a single task and record the outcome in DynamoDB
+
+    Args:
+        payload (dict): {"task_id": "uuid", "description": "user's task description"}
 
-    task_id = event.get('task_id')
-    description = event.get('description')
+    Returns:
+        dict: Status code and JSON body describing the outcome
+    """
+    task_id = payload.get('task_id')
+    description = payload.get('description')
 
     if not task_id or not description:
         print(f"ERROR: Missing required fields. task_id={task_id}, description={description}")
         return {
             'statusCode': 400,
-            'body': json.dumps({'error': 'Missing task_id or description'})
+            'body': orjson.dumps({'error': 'Missing task_id or description'}).decode()
         }
 
     try:
-        # Verify task exists
-        task = get_task(task_id)
-        if not task:
-            print(f"ERROR: Task {task_id} not found in DynamoDB")
-            return {
-                'statusCode': 404,
-                'body': json.dumps({'error': 'Task not found'})
-            }
-
-        # Update status to processing
+        # Claim the task: only a pending task moves to processing, so a redelivered
+        # SQS message (duplicate delivery or a retried batch) never runs the agent and
+        # re-sends outreach for a task that is already running or finished. This is
+        # also the existence check.
         print(f"Starting agent processing for task {task_id}")
-        update_task_status(task_id, "processing")
-        add_task_event(task_id, "Agent processing started", "info")
+        update_task_status(
+            task_id,
+            "processing",
+            events=[("Agent processing started", "info")],
+            expected_status="pending"
+        )
 
-        # Invoke the agent
-        agent_response = invoke_agent(task_id, description)
+        cache_key = _normalize_prompt(description)
+        agent_response = _get_cached_response(cache_key)
+
+        if agent_response is not None:
+            print(f"Serving task {task_id} from response cache")
+            # No outreach went out for this task, so drop the earlier task's email records
+            # and say so in the stored text
+            agent_response = {
+                'response': f"{agent_response.get('response', '')}\n\n{CACHED_RESPONSE_NOTE}",
+                'vendors': [
+                    {k: v for k, v in vendor.items() if k != 'emails'}
+                    for vendor in agent_response.get('vendors', [])
+                ],
+                'emails_sent': 0
+            }
+            completion_event = ("Agent response served from cache", "success")
+        else:
+            # Invoke the agent
+            agent_response = invoke_agent(task_id, description)
+            _cache_response(cache_key, agent_response)
+            completion_event = ("Agent completed task successfully", "success")
 
-        # Update task with successful response
-        update_task_with_agent_response(
+        # Store the response and mark as completed in one write
+        finalize_task(
             task_id,
+            "completed",
             agent_response.get('response', ''),
             vendors=agent_response.get('vendors', []),
-            emails_sent=agent_response.get('emails_sent', 0)
+            emails_sent=agent_response.get('emails_sent', 0),
+            events=[completion_event]
         )
 
-        # Mark as completed
-        update_task_status(task_id, "completed")
-        add_task_event(task_id, "Agent completed task successfully", "success")
-
         print(f"Task {task_id} completed successfully")
 
         return {
             'statusCode': 200,
-            'body': json.dumps({
+            'body': orjson.dumps({
                 'task_id': task_id,
                 'status': 'completed',
                 'message': 'Agent processing completed'
-            })
+            }).decode()
         }
 
     except Exception as e:
+        if _is_conditional_failure(e):
+            if 'Item' in e.response:
+                # The task exists but is not pending: another delivery already claimed it
+                print(f"Task {task_id} already claimed, skipping duplicate delivery")
+                return {
+                    'statusCode': 409,
+                    'body': orjson.dumps({'task_id': task_id, 'error': 'Task already processed or in progress'}).decode()
+                }
+            print(f"ERROR: Task {task_id} not found in DynamoDB")
+            return {
+                'statusCode': 404,
+                'body': orjson.dumps({'error': 'Task not found'}).decode()
+            }
+
         print(f"ERROR processing task {task_id}: {str(e)}")
 
         # Update task with error status
         try:
-            update_task_status(task_id, "error", error_message=str(e))
-            add_task_event(task_id, f"Agent error: {str(e)}", "error")
+            update_task_status(
+                task_id,
+                "error",
+                error_message=str(e),
+                events=[(f"Agent error: {str(e)}", "error")]
+            )
         except Exception as update_error:
             print(f"ERROR updating task status: {str(update_error)}")
 
         return {
             'statusCode': 500,
-            'body': json.dumps({
+            'body': orjson.dumps({
                 'task_id': task_id,
                 'status': 'error',
                 'error': str(e)
-            })
+            }).decode()
         }
 
 
+def _is_conditional_failure(error):
+    """Whether an error is a conditional task write that was rejected"""
+    return (
+        isinstance(error, ClientError)
+        and error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+    )
+
+
+def _normalize_prompt(description):
+    """Collapse case and whitespace so near-identical requests share a cache entry"""
+    return re.sub(r"\s+", " ", description.strip().lower())
+
+
+def _get_cached_response(cache_key):
+    """Return the cached agent response for a normalized prompt, or None"""
+    if not AGENT_RESPONSE_CACHE:
+        return None
+    with _response_cache_lock:
+        if cache_key not in _response_cache:
+            return None
+        _response_cache.move_to_end(cache_key)
+        return _response_cache[cache_key]
+
+
+def _cache_response(cache_key, agent_response):
+    """Store an agent response, evicting the least recently used entry when full"""
+    if not AGENT_RESPONSE_CACHE or agent_response.get('emails_sent'):
+        return
+    with _response_cache_lock:
+        _response_cache[cache_key] = agent_response
+        _response_cache.move_to_end(cache_key)
+        if len(_response_cache) > RESPONSE_CACHE_MAX:
+            _response_cache.popitem(last=False)
+
+
 def invoke_agent(task_id, user_input):
     """
     Invoke the AWS Bedrock AgentCore agent
@@ -124,30 +263,35 @@ def invoke_agent(task_id, user_input):
         }
     """
     try:
-        print(f"Invoking AgentCore agent for task {task_id}")
-        print(f"Agent Runtime ARN: {AGENT_RUNTIME_ARN}")
-        print(f"User input: {user_input}")
+        if _DEBUG:
+            print(f"Invoking AgentCore agent for task {task_id}")
+            print(f"Agent Runtime ARN: {AGENT_RUNTIME_ARN}")
+            print(f"User input: {user_input}")
 
-        # Prepare the payload
-        payload = json.dumps({"prompt": user_input})
+        # Prepare the payload (orjson emits bytes directly)
+        payload = orjson.dumps({"prompt": user_input})
 
         # Invoke agent runtime
-        response = bedrock_agentcore_client.invoke_agent_runtime(
+        response = get_bedrock_agentcore().invoke_agent_runtime(
             agentRuntimeArn=AGENT_RUNTIME_ARN,
-            payload=payload.encode('utf-8')
+            payload=payload
         )
 
         # Parse response
         status_code = response.get('statusCode', response.get('ResponseMetadata', {}).get('HTTPStatusCode'))
-        print(f"Agent response status: {status_code}")
+        if _DEBUG:
+            print(f"Agent response status: {status_code}")
 
         # Read the streaming response body
         response_stream = response.get('response')
-        if response_stream:
+        if response_stream and 'text/event-stream' in response.get('contentType', ''):
+            response_body = _consume_agent_stream(task_id, response_stream)
+        elif response_stream:
+            # orjson parses the raw bytes, so the body is never copied into a str
             response_bytes = response_stream.read()
-            response_text = response_bytes.decode('utf-8')
-            print(f"Agent response body: {response_text}")
-            response_body = json.loads(response_text)
+            if _DEBUG:
+                print(f"Agent response body (truncated): {response_bytes[:RESPONSE_LOG_MAX_BYTES].decode('utf-8', 'replace')}")
+            response_body = orjson.loads(response_bytes)
         else:
             print("No response body found")
             response_body = {}
@@ -162,17 +306,20 @@ def invoke_agent(task_id, user_input):
         emails = response_body.get("emails", [])
         emails_sent = response_body.get("emails_sent", 0)
 
-        print(f"Agent processing complete:")
-        print(f"  - Response: {agent_text[:200]}...")
-        print(f"  - Vendors: {len(vendors)}")
-        print(f"  - Emails sent: {emails_sent}")
+        if _DEBUG:
+            print(f"Agent processing complete:")
+            print(f"  - Response: {agent_text[:200]}...")
+            print(f"  - Vendors: {len(vendors)}")
+            print(f"  - Emails sent: {emails_sent}")
 
         # Store email details in vendors list for display
-        # Match emails to vendors by email address
+        # Group emails by recipient once, then match vendors by email address
+        emails_by_recipient = {}
+        for email in emails:
+            emails_by_recipient.setdefault(email.get('recipient'), []).append(email)
+
         for vendor in vendors:
-            vendor_email = vendor.get('email', '')
-            # Find matching emails sent to this vendor
-            vendor['emails'] = [e for e in emails if e.get('recipient') == vendor_email]
+            vendor['emails'] = emails_by_recipient.get(vendor.get('email', ''), [])
 
         return {
             'response': agent_text,
@@ -185,6 +332,59 @@ def invoke_agent(task_id, user_input):
         raise
 
 
+def _consume_agent_stream(task_id, response_stream):
+    """
+    Consume a server-sent event stream from AgentCore as it is generated
+
+    Text deltas are buffered and the task's progress_chunks is updated every
+    STREAM_PROGRESS_INTERVAL chunks; the final dict event carries the
+    response, vendors and emails.
+
+    Args:
+        task_id (str): Task ID for progress updates
+        response_stream: botocore StreamingBody of the agent response
+
+    Returns:
+        dict: Final response body
+
+    Raises:
+        Exception: If the agent reports an error or the stream ends without a final summary
+    """
+    text_chunks = []
+    response_body = None
+
+    for line in response_stream.iter_lines():
+        if not line.startswith(b"data: "):
+            continue
+
+        data = orjson.loads(line[6:])
+        if isinstance(data, dict):
+            # AgentCore still answers 200 when the agent fails mid-stream; the error arrives as an event
+            if "error" in data:
+                raise Exception(f"Agent error: {data['error']} ({data.get('error_type', 'unknown')})")
+            response_body = data
+            continue
+
+        text_chunks.append(data)
+        if len(text_chunks) % STREAM_PROGRESS_INTERVAL == 0:
+            try:
+                set_task_progress(task_id, len(text_chunks))
+            except Exception as e:
+                # Progress is best-effort; only a missing task should stop the run
+                if _is_conditional_failure(e):
+                    raise
+                print(f"WARNING: progress update failed for task {task_id}: {e}")
+
+    if response_body is None:
+        raise Exception(f"Agent stream ended without a final response ({len(text_chunks)} chunks received)")
+
+    if "response" not in response_body:
+        response_body["response"] = "".join(text_chunks)
+
+    print(f"Agent stream complete: {len(text_chunks)} chunks")
+    return response_body
+
+
 # For local testing
 if __name__ == "__main__":
     # Test event